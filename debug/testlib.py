@@ -1,9 +1,16 @@
+import atexit
 import collections
+import concurrent.futures
+import hashlib
+import mmap
+import multiprocessing
+import multiprocessing.util
 import os
 import os.path
 import random
 import re
 import shlex
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -22,16 +29,62 @@ real_stdout = sys.stdout
 # Note that gdb comes with its own testsuite. I was unable to figure out how to
 # run that testsuite against the spike simulator.
 
+# Patterns used to parse output from spike, OpenOCD, and gdb. These are
+# matched many times per test, so compile them once up front.
+
+# These describe a whole line, and are used with match() so a line that doesn't
+# fit fails at the first character instead of being scanned to the end.
+_RE_VCS_PORT = re.compile(r"Listening on port (\d+)$")
+_RE_INFO_REGISTER = re.compile(r"(\w+)\s+({.*})(?:\s+(\(.*\)))?")
+_RE_THREAD_LINE = re.compile(
+        r"[\s\*]*(\d+)\s*"
+        r'(Remote target'
+        r'|Thread (\d+)\s*(?:".*?")?\s*\(Name: ([^\)]+))'
+        r"\s*(.*)")
+
+# These can appear anywhere in a log or in multi-line command output, so they
+# have to be used with search().
+_RE_BITBANG_PORT = re.compile(
+        rb"Listening for remote bitbang connection on port (\d+).")
+_RE_DAISYCHAIN_PORT = re.compile(rb"Listening on port (\d+).")
+_RE_LOG_JUNK = re.compile(rb"[\x00\r\n]+")
+_RE_LOG_DEBUG = re.compile(rb"Debug: \d+ \d+ .*")
+_RE_REG = re.compile(r"(\w+) \(/\d+\): (0x[0-9A-F]+)")
+_RE_ANSI_ESCAPE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+_RE_CANNOT_ACCESS = re.compile(r"Cannot access memory at address (0x[0-9a-f]+)")
+_RE_HART = re.compile(r"Hart (\d+)")
+_RE_BREAKPOINT = re.compile(r"Breakpoint (\d+),? ")
+
+# Passed to pexpect's expect_list(), which skips compiling the pattern on
+# every call.
+_GDB_PROMPT = [re.compile(rb"\(gdb\)")]
+
+# How much pexpect reads from a child at a time. The default of 2000 bytes
+# means many small reads for large outputs like `info registers all`.
+# searchwindowsize is deliberately left unset: if it were set, pexpect would
+# only search the last searchwindowsize bytes of a large read, and could miss
+# the command echo at its start.
+PEXPECT_MAXREAD = 65536
+
 class TestLibError(Exception):
     pass
 
-def find_file(path):
-    for directory in (os.getcwd(), os.path.dirname(__file__)):
+# (cwd, path) -> result of find_file(), for files that were found.
+_find_file_cache = {}
+
+def find_file(path, cwd=None):
+    cwd = cwd or os.getcwd()
+    key = (cwd, path)
+    cached = _find_file_cache.get(key)
+    if cached is not None:
+        return cached
+    for directory in (cwd, os.path.dirname(__file__)):
         fullpath = os.path.join(directory, path)
-        relpath = os.path.relpath(fullpath)
+        relpath = os.path.relpath(fullpath, cwd)
         if len(relpath) >= len(fullpath):
             relpath = fullpath
         if os.path.exists(relpath):
+            _find_file_cache[key] = relpath
             return relpath
     return None
 
@@ -41,18 +94,77 @@ class CompileError(Exception):
         self.stdout = stdout
         self.stderr = stderr
 
+def compile_cache_key(cmd, inputs, output):
+    """Return a key that identifies the result of running cmd, or None if the
+    compiler can't be found. The output path isn't part of the key, so that
+    temporary binaries (see --isolate) can still be found in the cache. Input
+    files, and every file in the directories they (and any include
+    directories) live in, are identified by their size and mtime."""
+    compiler = shutil.which(cmd[0])
+    if not compiler:
+        return None
+    key = hashlib.sha1()
+    key.update(repr(["<output>" if arg == output else arg
+                     for arg in cmd]).encode())
+    directories = set(os.path.dirname(path) or "." for path in inputs)
+    directories.update(cmd[i + 1] for i, arg in enumerate(cmd[:-1])
+                       if arg == "-I")
+    paths = [compiler] + inputs
+    for directory in sorted(directories):
+        try:
+            paths += sorted(os.path.join(directory, name)
+                            for name in os.listdir(directory))
+        except OSError:
+            pass
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        key.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return key.hexdigest()
+
+def link_or_copy(source, destination):
+    """Make destination a copy of source, sharing the underlying file if
+    possible."""
+    tmp = f"{destination}.{os.getpid()}.tmp"
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copy(source, tmp)
+    os.replace(tmp, destination)
+
 gcc_cmd = None
+# Directory where compiled binaries are cached across runs. Set by
+# run_all_tests().
+compile_cache_dir = None
 def compile(args): # pylint: disable=redefined-builtin
     cmd = [gcc_cmd]
     cmd.append("-g")
-    for arg in args:
-        found = find_file(arg)
+    inputs = []
+    cwd = os.getcwd()
+    for i, arg in enumerate(args):
+        found = find_file(arg, cwd)
         if found:
             cmd.append(found)
+            if i == 0 or args[i - 1] != "-o":
+                inputs.append(found)
         else:
             cmd.append(arg)
     header("Compile")
     print("+", " ".join(cmd))
+
+    cached = None
+    if compile_cache_dir and "-o" in cmd[:-1]:
+        output = cmd[cmd.index("-o") + 1]
+        key = compile_cache_key(cmd, inputs, output)
+        if key:
+            cached = os.path.join(compile_cache_dir, f"{key}.elf")
+            if os.path.exists(cached):
+                print(f"Using cached {cached}")
+                link_or_copy(cached, output)
+                return
+
     with subprocess.Popen(cmd, stdout=subprocess.PIPE,
                           stderr=subprocess.PIPE) as process:
         stdout, stderr = process.communicate()
@@ -62,6 +174,35 @@ def compile(args): # pylint: disable=redefined-builtin
             header("")
             raise CompileError(stdout, stderr)
 
+    if cached:
+        os.makedirs(compile_cache_dir, exist_ok=True)
+        link_or_copy(output, cached)
+
+def wait_for_port(path, regex, timeout=3.3):
+    """Poll the log at path until regex (a compiled bytes pattern whose first
+    group is a port number) matches. Return the port, or None if it didn't
+    show up within timeout seconds.
+    The log is mapped rather than read, and each poll only scans lines that
+    weren't complete the last time. The delay between polls starts small and
+    doubles, so a fast start is noticed quickly."""
+    start = 0
+    delay = 0.01
+    deadline = time.time() + timeout
+    with open(path, "rb") as fd:
+        while True:
+            size = os.fstat(fd.fileno()).st_size
+            if size > start:
+                with mmap.mmap(fd.fileno(), size,
+                               access=mmap.ACCESS_READ) as log:
+                    m = regex.search(log, start)
+                    if m:
+                        return int(m.group(1))
+                    start = log.rfind(b"\n", start, size) + 1 or start
+            if time.time() > deadline:
+                return None
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
 class Spike:
     # pylint: disable=too-many-instance-attributes
     # pylint: disable=too-many-locals
@@ -101,21 +242,14 @@ class Spike:
         self.logfile.write(("+ " + " ".join(cmd) + "\n").encode())
         self.logfile.flush()
         # pylint: disable-next=consider-using-with
-        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+        self.process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
                 stdout=self.logfile, stderr=self.logfile)
 
         if with_jtag_gdb:
-            self.port = None
-            for _ in range(30):
-                with open(logname, encoding='utf-8') as fd:
-                    m = re.search(r"Listening for remote bitbang connection on "
-                            r"port (\d+).", fd.read())
-                if m:
-                    self.port = int(m.group(1))
-                    os.environ['REMOTE_BITBANG_PORT'] = m.group(1)
-                    break
-                time.sleep(0.11)
-            if not self.port:
+            self.port = wait_for_port(logname, _RE_BITBANG_PORT)
+            if self.port:
+                os.environ['REMOTE_BITBANG_PORT'] = str(self.port)
+            else:
                 print_log(logname)
                 raise TestLibError("Didn't get spike message about bitbang "
                         "connection")
@@ -212,17 +346,10 @@ class MultiSpike:
         self.logfile.write(f"+ {cmd}\n".encode())
         self.logfile.flush()
         # pylint: disable-next=consider-using-with
-        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+        self.process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
                 stdout=self.logfile, stderr=self.logfile)
 
-        self.port = None
-        for _ in range(30):
-            with open(self.lognames[-1], encoding='utf=8') as fd:
-                m = re.search(r"Listening on port (\d+).", fd.read())
-            if m:
-                self.port = int(m.group(1))
-                break
-            time.sleep(0.11)
+        self.port = wait_for_port(self.lognames[-1], _RE_DAISYCHAIN_PORT)
         if not self.port:
             print_log(self.lognames[-1])
             raise TestLibError(
@@ -266,7 +393,7 @@ class VcsSim:
         with open(self.logname, "r", encoding='utf-8') as listenfile:
             listenfile.seek(0, 2)
             # pylint: disable-next=consider-using-with
-            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+            self.process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
                     stdout=logfile, stderr=logfile)
             done = False
             start = time.time()
@@ -280,7 +407,7 @@ class VcsSim:
                 line = listenfile.readline()
                 if not line:
                     time.sleep(1)
-                match = re.match(r"^Listening on port (\d+)$", line)
+                match = _RE_VCS_PORT.match(line)
                 if match:
                     done = True
                     self.port = int(match.group(1))
@@ -309,6 +436,15 @@ class Openocd:
         self.debug_openocd = debug_openocd
         self.command_count = 0
 
+        if reuse_servers:
+            # Pooled servers outlive the test that started them, so they can't
+            # share the class-level log: the next Openocd would truncate it
+            # while they are still writing to it.
+            # pylint: disable-next=consider-using-with
+            self.logfile = tempfile.NamedTemporaryFile(prefix='openocd',
+                                                       suffix='.log')
+            self.logname = self.logfile.name
+
         if server_cmd:
             cmd = shlex.split(server_cmd)
         else:
@@ -343,9 +479,9 @@ class Openocd:
             extra_env['USE_FREERTOS'] = "0"
 
         # pylint: disable-next=consider-using-with
-        raw_logfile = open(Openocd.logname, "wb")
+        raw_logfile = open(self.logname, "wb")
         # pylint: disable-next=consider-using-with
-        self.read_log_fd = open(Openocd.logname, "rb")
+        self.read_log_fd = open(self.logname, "rb")
         self.log_buf = b""
         try:
             # pylint: disable-next=consider-using-with
@@ -355,7 +491,7 @@ class Openocd:
         except FileNotFoundError:
             logfile = raw_logfile
         if print_log_names:
-            real_stdout.write(f"Temporary OpenOCD log: {Openocd.logname}\n")
+            real_stdout.write(f"Temporary OpenOCD log: {self.logname}\n")
         env_entries = ("REMOTE_BITBANG_HOST", "REMOTE_BITBANG_PORT",
                 "WORK_AREA")
         env_entries = [key for key in env_entries if key in os.environ]
@@ -372,7 +508,7 @@ class Openocd:
         self.start(cmd, logfile, extra_env)
 
         self.openocd_cli = pexpect.spawn(f"nc localhost {self.tclrpc_port}",
-            echo=False)
+            echo=False, maxread=PEXPECT_MAXREAD)
         # TCL-RPC uses \x1a as a watermark for end of message. We set raw
         # pty mode to disable translation of \x1a to EOF
         tty.setraw(self.openocd_cli.child_fd)
@@ -384,7 +520,7 @@ class Openocd:
     def start(self, cmd, logfile, extra_env):
         combined_env = {**os.environ, **extra_env}
         # pylint: disable-next=consider-using-with
-        self.process = subprocess.Popen(cmd, stdin=None,
+        self.process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
                 stdout=logfile, stderr=logfile, env=combined_env)
 
         try:
@@ -421,7 +557,7 @@ class Openocd:
                 self.debugger = subprocess.Popen(["gnome-terminal", "-e",
                                             f"gdb --pid={self.process.pid}"])
         except Exception:
-            print_log(Openocd.logname)
+            print_log(self.logname)
             raise
 
     def __del__(self):
@@ -459,24 +595,35 @@ class Openocd:
         We read the logfile to tell us what OpenOCD has done."""
         messaged = False
         start = time.time()
+        pattern = re.compile(regex, re.MULTILINE | re.DOTALL)
+        searched = False
+        delay = 0.01
 
         while True:
-            for line in self.read_log_fd.readlines():
+            lines = self.read_log_fd.readlines()
+            parts = [self.log_buf]
+            for line in lines:
                 line = line.rstrip()
                 # Remove nulls, carriage returns, and newlines.
-                line = re.sub(rb"[\x00\r\n]+", b"", line)
+                line = _RE_LOG_JUNK.sub(b"", line)
                 # Remove debug messages.
-                debug_match = re.search(rb"Debug: \d+ \d+ .*", line)
+                debug_match = _RE_LOG_DEBUG.search(line)
                 if debug_match:
-                    line = line[:debug_match.start()] + line[debug_match.end():]
-                    self.log_buf += line
+                    parts.append(line[:debug_match.start()])
+                    parts.append(line[debug_match.end():])
                 else:
-                    self.log_buf += line + b"\n"
-
-            m = re.search(regex, self.log_buf, re.MULTILINE | re.DOTALL)
-            if m:
-                self.log_buf = self.log_buf[m.end():]
-                return m
+                    parts.append(line)
+                    parts.append(b"\n")
+
+            # Only search again if there's something new to find.
+            if lines or not searched:
+                # Join once, instead of growing log_buf a line at a time.
+                self.log_buf = b"".join(parts)
+                m = pattern.search(self.log_buf)
+                if m:
+                    self.log_buf = self.log_buf[m.end():]
+                    return m
+                searched = True
 
             if not self.process.poll() is None:
                 raise TestLibError("OpenOCD exited early.")
@@ -487,9 +634,15 @@ class Openocd:
 
             if (time.time() - start) > self.timeout:
                 raise TestLibError(f"Timed out waiting for {regex} in "
-                                   f"{Openocd.logname}")
+                                   f"{self.logname}")
 
-            time.sleep(0.1)
+            # Keep reading without a pause while OpenOCD is writing, and back
+            # off gradually when it isn't.
+            if lines:
+                delay = 0.01
+            else:
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
 
     def targets(self):
         """Run `targets` command."""
@@ -542,7 +695,8 @@ class Openocd:
 class OpenocdCli:
     def __init__(self, port=4444):
         self.child = pexpect.spawn(
-                f"sh -c 'telnet localhost {port} | tee openocd-cli.log'")
+                f"sh -c 'telnet localhost {port} | tee openocd-cli.log'",
+                maxread=PEXPECT_MAXREAD)
         self.child.expect("> ")
 
     def command(self, cmd):
@@ -554,7 +708,7 @@ class OpenocdCli:
 
     def reg(self, reg=''):
         output = self.command(f"reg {reg}")
-        matches = re.findall(r"(\w+) \(/\d+\): (0x[0-9A-F]+)", output)
+        matches = _RE_REG.findall(output)
         values = {r: int(v, 0) for r, v in matches}
         if reg:
             return values[reg]
@@ -601,43 +755,69 @@ class UnknownThread(Exception):
 class ThreadTerminated(Exception):
     pass
 
-Thread = collections.namedtuple('Thread', ('id', 'description', 'target_id',
-    'name', 'frame'))
+class Thread:
+    """One line of `info threads` output."""
+    __slots__ = ('id', 'description', 'target_id', 'name', 'frame')
+
+    # pylint: disable-next=redefined-builtin
+    def __init__(self, id, description, target_id, name, frame):
+        self.id = id
+        self.description = description
+        self.target_id = target_id
+        self.name = name
+        self.frame = frame
+
+    # Tests also treat threads as tuples, like the namedtuple this used to be.
+    def __iter__(self):
+        return (getattr(self, field) for field in self.__slots__)
+
+    def __getitem__(self, index):
+        return getattr(self, self.__slots__[index])
+
+    def __eq__(self, other):
+        return isinstance(other, Thread) and tuple(self) == tuple(other)
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}"
+                           for field in self.__slots__)
+        return f"Thread({fields})"
 
 class Repeat:
     def __init__(self, count):
         self.count = count
 
+_TOKENS = tuple((re.compile(regex), fn) for regex, fn in (
+        (r"[\s]+", lambda m: None),
+        (r"[,{}=]", lambda m: m.group(0)),
+        (r"0x[\da-fA-F]+", lambda m: int(m.group(0)[2:], 16)),
+        (r"-?\d*\.\d+(e[-+]\d+)?", lambda m: float(m.group(0))),
+        (r"-?\d+", lambda m: int(m.group(0))),
+        # We want something that can compare equal, and float(nan) does
+        # not do that. So use something else that isn't good for math,
+        # but we don't actually do math with NaN.
+        (r"-?nan\(0x[a-f0-9]+\)", lambda m: "nan"),
+        (r"<repeats (\d+) times>", lambda m: Repeat(int(m.group(1)))),
+        (r"Could not fetch register \"(\w+)\"; (.*)$",
+            lambda m: CouldNotFetch(m.group(1), m.group(2))),
+        (r"Could not read registers; (.*)$",
+            lambda m: CouldNotReadRegisters(m.group(1))),
+        (r"Cannot access memory at address (0x[0-9a-f]+)",
+            lambda m: CannotAccess(int(m.group(1), 0))),
+        (r"Cannot insert breakpoint (\d+).",
+            lambda m: CannotInsertBreakpoint(int(m.group(1)))),
+        (r'No symbol "(\w+)" in current context.',
+            lambda m: NoSymbol(m.group(1))),
+        (r'"([^"]*)"', lambda m: m.group(1)),
+        (r"[a-zA-Z][a-zA-Z\d]*", lambda m: m.group(0)),
+        ))
+
 def tokenize(text):
     index = 0
     while index < len(text):
-        for regex, fn in (
-                (r"[\s]+", lambda m: None),
-                (r"[,{}=]", lambda m: m.group(0)),
-                (r"0x[\da-fA-F]+", lambda m: int(m.group(0)[2:], 16)),
-                (r"-?\d*\.\d+(e[-+]\d+)?", lambda m: float(m.group(0))),
-                (r"-?\d+", lambda m: int(m.group(0))),
-                # We want something that can compare equal, and float(nan) does
-                # not do that. So use something else that isn't good for math,
-                # but we don't actually do math with NaN.
-                (r"-?nan\(0x[a-f0-9]+\)", lambda m: "nan"),
-                (r"<repeats (\d+) times>", lambda m: Repeat(int(m.group(1)))),
-                (r"Could not fetch register \"(\w+)\"; (.*)$",
-                    lambda m: CouldNotFetch(m.group(1), m.group(2))),
-                (r"Could not read registers; (.*)$",
-                    lambda m: CouldNotReadRegisters(m.group(1))),
-                (r"Cannot access memory at address (0x[0-9a-f]+)",
-                    lambda m: CannotAccess(int(m.group(1), 0))),
-                (r"Cannot insert breakpoint (\d+).",
-                    lambda m: CannotInsertBreakpoint(int(m.group(1)))),
-                (r'No symbol "(\w+)" in current context.',
-                    lambda m: NoSymbol(m.group(1))),
-                (r'"([^"]*)"', lambda m: m.group(1)),
-                (r"[a-zA-Z][a-zA-Z\d]*", lambda m: m.group(0)),
-                ):
-            m = re.match(regex, text[index:])
+        for regex, fn in _TOKENS:
+            m = regex.match(text, index)
             if m:
-                index += len(m.group(0))
+                index = m.end()
                 token = fn(m)
                 if not token is None:
                     yield token
@@ -647,28 +827,28 @@ def tokenize(text):
 
 def parse_dict(tokens):
     assert tokens[0] == "{"
-    tokens.pop(0)
+    tokens.popleft()
     result = {}
     while True:
-        key = tokens.pop(0)
-        assert tokens.pop(0) == "="
+        key = tokens.popleft()
+        assert tokens.popleft() == "="
         value = parse_tokens(tokens)
         result[key] = value
-        token = tokens.pop(0)
+        token = tokens.popleft()
         if token == "}":
             return result
         assert token == ","
 
 def parse_list(tokens):
     assert tokens[0] == "{"
-    tokens.pop(0)
+    tokens.popleft()
     result = []
     while True:
-        result.append(tokens.pop(0))
-        token = tokens.pop(0)
+        result.append(tokens.popleft())
+        token = tokens.popleft()
         if isinstance(token, Repeat):
             result += [result[-1]] * (token.count - 1)
-            token = tokens.pop(0)
+            token = tokens.popleft()
         if token == "}":
             return result
         assert token == ","
@@ -684,20 +864,29 @@ def parse_tokens(tokens):
     if isinstance(tokens[0], Exception):
         raise tokens[0]
     if isinstance(tokens[0], (float, int)):
-        return tokens.pop(0)
+        return tokens.popleft()
     if tokens[0] == "{":
         return parse_dict_or_list(tokens)
     if isinstance(tokens[0], str):
-        return tokens.pop(0)
-    raise TestLibError(f"Unsupported tokens: {tokens!r}")
+        return tokens.popleft()
+    raise TestLibError(f"Unsupported tokens: {list(tokens)!r}")
 
 def parse_rhs(text):
-    tokens = list(tokenize(text))
+    # Tokens are consumed from the front, which is O(1) for a deque but O(n)
+    # for a list. That matters for large arrays.
+    tokens = collections.deque(tokenize(text))
     result = parse_tokens(tokens)
     if tokens:
-        raise TestLibError(f"Unexpected input: {tokens!r}")
+        raise TestLibError(f"Unexpected input: {list(tokens)!r}")
     return result
 
+# gdb commands after which gdb may have a different thread selected, either
+# because they select one or because the target stops in some other thread.
+_THREAD_SWITCHING_COMMANDS = frozenset((
+    "c", "continue", "s", "step", "si", "stepi", "n", "next", "ni", "nexti",
+    "finish", "until", "advance", "jump", "run", "start", "signal", "thread",
+    "target", "disconnect", "kill", "detach", "attach", "interrupt"))
+
 class CommandException(Exception):
     pass
 
@@ -730,6 +919,8 @@ class Gdb:
         self.reset_delay_index = 0
         self.stack = []
         self.harts = {}
+        # Thread id we last selected in each child, if it's still selected.
+        self.selected_thread = {}
 
         self.logfiles = []
         self.children = []
@@ -740,20 +931,27 @@ class Gdb:
             self.logfiles.append(logfile)
             if print_log_names:
                 real_stdout.write(f"Temporary gdb log: {logfile.name}\n")
-            child = pexpect.spawn(self.cmd)
+            child = pexpect.spawn(self.cmd, maxread=PEXPECT_MAXREAD)
             child.logfile = logfile
             child.logfile.write(f"+ {self.cmd}\n".encode())
             self.children.append(child)
-            self.select_child(child)
-            self.wait()
-            self.command("set style enabled off", reset_delays=None)
-            self.command("set confirm off", reset_delays=None)
-            self.command("set width 0", reset_delays=None)
-            self.command("set height 0", reset_delays=None)
-            # Force consistency.
-            self.command("set print entry-values no", reset_delays=None)
-            self.command(f"set remotetimeout {self.timeout}", reset_delays=None)
-            if logremote:
+        self.active_child = self.children[0]
+
+        # Let the gdbs start up in parallel.
+        with PrivateState(self):
+            for child in self.children:
+                self.select_child(child)
+                self.wait()
+        for command in ("set style enabled off", "set confirm off",
+                        "set width 0", "set height 0",
+                        # Force consistency.
+                        "set print entry-values no",
+                        f"set remotetimeout {self.timeout}"):
+            self.pipeline_command([(child, command)
+                                   for child in self.children])
+        if logremote:
+            remotelog_commands = []
+            for port, child in zip(ports, self.children):
                 # pylint: disable-next=consider-using-with
                 remotelog = tempfile.NamedTemporaryFile(
                     prefix=f"remote.gdb@{port}-", suffix=".log")
@@ -761,25 +959,30 @@ class Gdb:
                     real_stdout.write(
                         f"Temporary remotelog: {remotelog.name}\n")
                 self.logfiles.append(remotelog)
-                self.command(f"set remotelogfile {remotelog.name}",
-                             reset_delays=None)
-        self.active_child = self.children[0]
+                remotelog_commands.append(
+                    (child, f"set remotelogfile {remotelog.name}"))
+            self.pipeline_command(remotelog_commands)
 
     def connect(self):
+        self.pipeline_command([
+            (child, f"target extended-remote localhost:{port}")
+            for port, child in zip(self.ports, self.children)], ops=10)
+        loads = [(child, f"file {binary}")
+                 for child, binary in zip(self.children, self.binaries)
+                 if binary]
+        self.pipeline_command([
+            (child, f"monitor riscv reset_delays {self.next_reset_delays()}")
+            for child, _ in loads])
+        for output in self.pipeline_command(loads):
+            assertIn("Reading symbols", output)
         with PrivateState(self):
-            for port, child, binary in zip(self.ports, self.children,
-                                        self.binaries):
+            for child in self.children:
                 self.select_child(child)
-                self.command(f"target extended-remote localhost:{port}",
-                        ops=10, reset_delays=None)
-                if binary:
-                    output = self.command(f"file {binary}")
-                    assertIn("Reading symbols", output)
                 threads = self.threads()
                 for t in threads:
                     hartid = None
                     if t.name:
-                        m = re.search(r"Hart (\d+)", t.name)
+                        m = _RE_HART.search(t.name)
                         if m:
                             hartid = int(m.group(1))
                     if hartid is None:
@@ -815,11 +1018,14 @@ class Gdb:
         h = self.harts[hart.id]
         self.select_child(h['child'])
         if not h['solo']:
+            if self.selected_thread.get(h['child']) == h['thread'].id:
+                return
             output = self.command(f"thread {h['thread'].id}", ops=5)
             if "Unknown" in output:
                 raise UnknownThread(output)
             if f"Thread ID {h['thread'].id} has terminated" in output:
                 raise ThreadTerminated(output)
+            self.selected_thread[h['child']] = h['thread'].id
 
     def push_state(self):
         self.stack.append({
@@ -832,7 +1038,7 @@ class Gdb:
 
     def wait(self):
         """Wait for prompt."""
-        self.active_child.expect(r"\(gdb\)")
+        self.active_child.expect_list(_GDB_PROMPT)
 
     def command(self, command, ops=1, reset_delays=0):
         """ops is the estimated number of operations gdb will have to perform
@@ -840,25 +1046,43 @@ class Gdb:
         self.timeout."""
         if not reset_delays is None:
             if reset_delays == 0:
-                reset_delays = self.reset_delays[self.reset_delay_index]
-                self.reset_delay_index = (self.reset_delay_index + 1) % \
-                        len(self.reset_delays)
+                reset_delays = self.next_reset_delays()
             self.command(f"monitor riscv reset_delays {reset_delays}",
                     reset_delays=None)
-        timeout = max(1, ops) * self.timeout
+        self.send_command(command)
+        return self.complete_command(command, ops)
+
+    def next_reset_delays(self):
+        reset_delays = self.reset_delays[self.reset_delay_index]
+        self.reset_delay_index = (self.reset_delay_index + 1) % \
+                len(self.reset_delays)
+        return reset_delays
+
+    def send_command(self, command):
+        """Send command to the active child without waiting for it to
+        complete."""
+        words = command.split(maxsplit=1)
+        if words and words[0].rstrip("&") in _THREAD_SWITCHING_COMMANDS:
+            self.selected_thread.pop(self.active_child, None)
         self.active_child.sendline(command)
+
+    def complete_command(self, command, ops=1):
+        """Wait for a command sent with send_command() to the active child to
+        complete, and return its output."""
+        timeout = max(1, ops) * self.timeout
         try:
-            self.active_child.expect(re.escape(command), timeout=timeout)
-            self.active_child.expect("\n", timeout=timeout)
+            # Match the echoed command and the rest of its line in one go.
+            self.active_child.expect_list(
+                [re.compile(re.escape(command.encode()) + rb"[^\n]*\n")],
+                timeout=timeout)
         except pexpect.exceptions.TIMEOUT as exc:
             raise CommandSendTimeout(command) from exc
         try:
-            self.active_child.expect(r"\(gdb\)", timeout=timeout)
+            self.active_child.expect_list(_GDB_PROMPT, timeout=timeout)
         except pexpect.exceptions.TIMEOUT as exc:
             raise CommandCompleteTimeout(command) from exc
         output = self.active_child.before.decode("utf-8", errors="ignore")
-        ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-        return ansi_escape.sub('', output).strip()
+        return _RE_ANSI_ESCAPE.sub('', output).strip()
 
     def interact(self):
         """Call this from a test at a point where you just want to interact with
@@ -879,11 +1103,26 @@ class Gdb:
 
 
     def global_command(self, command):
-        """Execute this command on every gdb that we control."""
+        """Execute this command on every gdb that we control. The command is
+        sent to every gdb before waiting for any of them to complete."""
+        self.pipeline_command([
+            (child, f"monitor riscv reset_delays {self.next_reset_delays()}")
+            for child in self.children])
+        self.pipeline_command([(child, command) for child in self.children])
+
+    def pipeline_command(self, child_commands, ops=1):
+        """Send each (child, command) pair in child_commands, and only then
+        wait for them all to complete, so that the gdbs work in parallel.
+        Returns the output of each command."""
         with PrivateState(self):
-            for child in self.children:
+            for child, command in child_commands:
+                self.select_child(child)
+                self.send_command(command)
+            outputs = []
+            for child, command in child_commands:
                 self.select_child(child)
-                self.command(command)
+                outputs.append(self.complete_command(command, ops))
+        return outputs
 
     def system_command(self, command, ops=20):
         """Execute this command on every unique system that we control."""
@@ -917,6 +1156,7 @@ class Gdb:
                 assert "Could not insert hardware" not in output
             return output
         else:
+            self.selected_thread.pop(self.active_child, None)
             self.active_child.sendline(f"c{sync}")
             self.active_child.expect("Continuing", timeout=ops * self.timeout)
             return ""
@@ -934,19 +1174,21 @@ class Gdb:
         second hart even gets to resume, so it will never hit the breakpoint.
         """
         with PrivateState(self):
+            self.selected_thread.clear()
             for child in self.children:
                 child.sendline("c")
                 child.expect("Continuing")
 
             if wait:
                 for child in self.children:
-                    child.expect(r"\(gdb\)")
+                    child.expect_list(_GDB_PROMPT)
 
     def interrupt(self, ops=None):
         if not ops:
             ops = len(self.harts)
+        self.selected_thread.pop(self.active_child, None)
         self.active_child.send("\003")
-        self.active_child.expect(r"\(gdb\)", timeout=self.timeout * ops)
+        self.active_child.expect_list(_GDB_PROMPT, timeout=self.timeout * ops)
         return self.active_child.before.strip().decode()
 
     def interrupt_all(self):
@@ -956,24 +1198,41 @@ class Gdb:
                 self.interrupt()
 
     def x(self, address, size='w', count=1):
-        output = self.command(f"x/{count}{size} {address}", ops=count / 16)
+        # Ask for hex explicitly, since otherwise gdb uses whatever format was
+        # used last. That also means values can be parsed as base 16.
+        output = self.command(f"x/{count}x{size} {address}", ops=count / 16)
         values = []
         for line in output.splitlines():
-            for value in line.split(':')[1].strip().split():
-                values.append(int(value, 0))
+            for value in line.split(':', 1)[1].split():
+                values.append(int(value, 16))
         if len(values) == 1:
             return values[0]
         return values
 
+    @staticmethod
+    def cannot_access(output):
+        """Return a CannotAccess exception if output reports a memory access
+        error, otherwise None."""
+        # Much cheaper than the regex, and almost always false.
+        if "Cannot access" not in output:
+            return None
+        m = _RE_CANNOT_ACCESS.search(output)
+        if m:
+            return CannotAccess(int(m.group(1), 16))
+        return None
+
     def p_raw(self, obj):
         output = self.command(f"p {obj}")
-        m = re.search("Cannot access memory at address (0x[0-9a-f]+)", output)
-        if m:
-            raise CannotAccess(int(m.group(1), 0))
+        error = self.cannot_access(output)
+        if error:
+            raise error
         return output.split('=', 1)[-1].strip()
 
     def p(self, obj, fmt="/x", ops=1):
         output = self.command(f"p{fmt} {obj}", ops=ops).splitlines()[-1]
+        error = self.cannot_access(output)
+        if error:
+            raise error
         rhs = output.split('=', 1)[-1]
         return parse_rhs(rhs)
 
@@ -992,7 +1251,7 @@ class Gdb:
         output = self.command(f"info registers {group}", ops=ops)
         result = {}
         for line in output.splitlines():
-            m = re.match(r"(\w+)\s+({.*})(?:\s+(\(.*\)))?", line)
+            m = _RE_INFO_REGISTER.match(line)
             if m:
                 parts = m.groups()
             else:
@@ -1008,6 +1267,7 @@ class Gdb:
         if wait:
             return self.command("stepi", ops=10)
         else:
+            self.selected_thread.pop(self.active_child, None)
             self.active_child.sendline("stepi")
             self.active_child.expect("stepi", timeout=self.timeout)
             return ""
@@ -1027,7 +1287,7 @@ class Gdb:
         output = self.command(f"b {location}", ops=5)
         assert "not defined" not in output
         assert "Breakpoint" in output
-        m = re.search(r"Breakpoint (\d+),? ", output)
+        m = _RE_BREAKPOINT.search(output)
         assert m, output
         return int(m.group(1))
 
@@ -1056,11 +1316,10 @@ class Gdb:
         output = self.command("info threads", ops=100)
         threads = []
         for line in output.splitlines():
-            m = re.match(
-                    r"[\s\*]*(\d+)\s*"
-                    r'(Remote target'
-                    r'|Thread (\d+)\s*(?:".*?")?\s*\(Name: ([^\)]+))'
-                    r"\s*(.*)", line)
+            # Cheap check to skip the header and frame lines.
+            if "Thread" not in line and "Remote target" not in line:
+                continue
+            m = _RE_THREAD_LINE.match(line)
             if m:
                 threads.append(Thread(*m.groups()))
         assert threads
@@ -1145,10 +1404,14 @@ def run_all_tests(module, target, parsed):
     gdb_cmd = parsed.gdb
     global gcc_cmd  # pylint: disable=global-statement
     gcc_cmd = parsed.gcc
+    global compile_cache_dir  # pylint: disable=global-statement
+    compile_cache_dir = os.path.join(parsed.logs, ".ccache")
     global target_timeout  # pylint: disable=global-statement
     target_timeout = parsed.target_timeout
     global remotelogfile_enable  # pylint: disable=global-statement
     remotelogfile_enable = parsed.remotelogfile_enable
+    global reuse_servers  # pylint: disable=global-statement
+    reuse_servers = parsed.reuse_servers
 
     examine_added = False
     for hart in target.harts:
@@ -1179,47 +1442,131 @@ def run_all_tests(module, target, parsed):
     return print_results(results)
 
 good_results = set(('pass', 'not_applicable'))
+def run_test(parsed, target, name, definition, hart):
+    """Run a single test, logging its output to a new file in parsed.logs.
+    Return the result and the name of that file."""
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    log_name = os.path.join(parsed.logs,
+                            f"{timestamp}-"
+                            f"{type(target).__name__}-{name}.log")
+    # pylint: disable-next=consider-using-with
+    log_fd = open(log_name, 'w', encoding='utf-8')
+    print(f"[{name}] Starting > {log_name}")
+    instance = definition(target, hart)
+    sys.stdout.flush()
+    log_fd.write(f"Test: {name}\n")
+    log_fd.write(f"Target: {type(target).__name__}\n")
+    start = time.time()
+    global real_stdout  # pylint: disable=global-statement
+    real_stdout = sys.stdout
+    sys.stdout = log_fd
+    try:
+        result = instance.run()
+        log_fd.write(f"Result: {result}\n")
+        log_fd.write(f"Logfile: {log_name}\n")
+        log_fd.write(f"Reproduce: {sys.argv[0]} {parsed.target} {name}")
+        if len(target.harts) > 1:
+            log_fd.write(f" --hart {instance.hart.id}")
+        log_fd.write("\n")
+    finally:
+        sys.stdout = real_stdout
+        log_fd.write(f"Time elapsed: {time.time() - start:.2f}s\n")
+        log_fd.flush()
+    print(f"[{name}] {result} in {time.time() - start:.2f}s")
+    if result not in good_results and parsed.print_failures:
+        with open(log_name, encoding='utf-8') as handle:
+            sys.stdout.write(handle.read())
+    sys.stdout.flush()
+    return result, log_name
+
+# (parsed, target, todo) for the tests being run by worker processes. Worker
+# processes are forked, so they inherit this instead of having it pickled.
+worker_tests = None
+
+inherited_logfiles = []
+
+def init_worker():
+    # OpenOCD and VCS share one log per process, so give each worker its own.
+    for cls, prefix in ((Openocd, 'openocd'), (VcsSim, 'simv')):
+        # Keep the parent's log objects alive, or they would delete the
+        # parent's files when they're garbage collected here.
+        inherited_logfiles.append(cls.logfile)
+        # pylint: disable-next=consider-using-with
+        cls.logfile = tempfile.NamedTemporaryFile(prefix=prefix,
+                                                  suffix='.log')
+        cls.logname = cls.logfile.name
+        multiprocessing.util.Finalize(None, cls.logfile.close, exitpriority=0)
+    VcsSim.lognames = [VcsSim.logname]
+
+    # Workers exit without running finalizers on their own objects, so
+    # explicitly delete the temporary binaries (--isolate) compiled here. The
+    # ones inherited from the parent are left for the parent to delete.
+    _, target, _ = worker_tests
+    multiprocessing.util.Finalize(None, close_new_temporary_files,
+            args=(target.temporary_files, len(target.temporary_files)),
+            exitpriority=0)
+
+    # Likewise the atexit hook that shuts down pooled servers doesn't run in
+    # workers. Shut them down before the logs they write to are deleted.
+    multiprocessing.util.Finalize(None, BaseTest.server_pool.clear,
+            exitpriority=1)
+
+def close_new_temporary_files(temporary_files, inherited):
+    for temporary_file in temporary_files[inherited:]:
+        temporary_file.close()
+
+def run_worker_test(index):
+    parsed, target, todo = worker_tests
+    name, definition, hart = todo[index]
+    return run_test(parsed, target, name, definition, hart)
+
 def run_tests(parsed, target, todo):
+    if parsed.jobs > 1 and not getattr(parsed, "isolate", False):
+        raise TestLibError("--jobs requires --isolate, so that tests running "
+                           "at the same time don't overwrite each other's "
+                           "binaries.")
+
     results = {}
     count = 0
 
-    for name, definition, hart in todo:
-        timestamp = time.strftime("%Y%m%d-%H%M%S")
-        log_name = os.path.join(parsed.logs,
-                                f"{timestamp}-"
-                                f"{type(target).__name__}-{name}.log")
-        # pylint: disable-next=consider-using-with
-        log_fd = open(log_name, 'w', encoding='utf-8')
-        print(f"[{name}] Starting > {log_name}")
-        instance = definition(target, hart)
-        sys.stdout.flush()
-        log_fd.write(f"Test: {name}\n")
-        log_fd.write(f"Target: {type(target).__name__}\n")
-        start = time.time()
-        global real_stdout  # pylint: disable=global-statement
-        real_stdout = sys.stdout
-        sys.stdout = log_fd
-        try:
-            result = instance.run()
-            log_fd.write(f"Result: {result}\n")
-            log_fd.write(f"Logfile: {log_name}\n")
-            log_fd.write(f"Reproduce: {sys.argv[0]} {parsed.target} {name}")
-            if len(target.harts) > 1:
-                log_fd.write(f" --hart {instance.hart.id}")
-            log_fd.write("\n")
-        finally:
-            sys.stdout = real_stdout
-            log_fd.write(f"Time elapsed: {time.time() - start:.2f}s\n")
-            log_fd.flush()
-        print(f"[{name}] {result} in {time.time() - start:.2f}s")
-        if result not in good_results and parsed.print_failures:
-            with open(log_name, encoding='utf-8') as handle:
-                sys.stdout.write(handle.read())
-        sys.stdout.flush()
+    # ExamineTarget fills in misa, which every other test depends on, so it
+    # always runs by itself first.
+    while todo and (parsed.jobs <= 1 or todo[0][1] is ExamineTarget):
+        name, definition, hart = todo.pop(0)
+        result, log_name = run_test(parsed, target, name, definition, hart)
         results.setdefault(result, []).append((name, log_name))
         count += 1
         if result not in good_results and parsed.fail_fast:
-            break
+            return results, count
+
+    if not todo:
+        return results, count
+
+    # Servers pooled by ExamineTarget (--reuse-servers) can't be used by the
+    # workers, which aren't their parent process. Shut them down now rather
+    # than keeping them idle until exit, and so the workers don't inherit
+    # them and delete their logs when dropping them.
+    BaseTest.server_pool.clear()
+
+    # Pick harts here, so that the choice still only depends on the seed.
+    global worker_tests  # pylint: disable=global-statement
+    worker_tests = (parsed, target,
+                    [(name, definition,
+                      random.choice(target.harts) if hart is None else hart)
+                     for name, definition, hart in todo])
+    with concurrent.futures.ProcessPoolExecutor(max_workers=parsed.jobs,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_worker) as pool:
+        futures = {pool.submit(run_worker_test, i): name
+                   for i, (name, _, _) in enumerate(todo)}
+        for future in concurrent.futures.as_completed(futures):
+            result, log_name = future.result()
+            results.setdefault(result, []).append((futures[future], log_name))
+            count += 1
+            if result not in good_results and parsed.fail_fast:
+                for f in futures:
+                    f.cancel()
+                break
 
     return results, count
 
@@ -1275,6 +1622,15 @@ def add_test_run_options(parser):
     parser.add_argument("--hart",
             help="Run tests against this hart in multihart tests.",
             default=None, type=int)
+    parser.add_argument("--jobs", "-j", default=1, type=int,
+            help="Run this many tests at the same time, each in its own "
+            "process with its own simulator and debug server. Requires "
+            "--isolate.")
+    parser.add_argument("--reuse-servers", action="store_true",
+            help="Keep the simulator and debug server running between tests, "
+            "and reset the target instead of starting new ones for every "
+            "test. This is faster, but state left behind by one test may "
+            "affect the next.")
 
 def header(title, dash='-', length=78):
     if title:
@@ -1287,8 +1643,7 @@ def header(title, dash='-', length=78):
 
 def print_log_handle(name, handle):
     header(name)
-    for l in handle:
-        sys.stdout.write(l)
+    shutil.copyfileobj(handle, sys.stdout, 8192)
     print()
 
 def print_log(path):
@@ -1298,6 +1653,10 @@ def print_log(path):
 class BaseTest:
     # pylint: disable=too-many-instance-attributes
     compiled = {}
+    # (target_process, server) pairs that are kept alive between tests when
+    # --reuse-servers is used, keyed by target name and whether FreeRTOS
+    # support is enabled.
+    server_pool = {}
 
     def __init__(self, target, hart=None):
         self.target = target
@@ -1308,9 +1667,13 @@ class BaseTest:
             #self.hart = target.harts[-1]
         self.server = None
         self.target_process = None
+        self.server_reused = False
+        self.result = None
         self.binary = None
         self.start = 0
         self.logs = []
+        # Where this test's output starts in logs shared with earlier tests.
+        self.log_offsets = {}
         self.binaries = []
 
     def early_applicable(self):
@@ -1337,8 +1700,31 @@ class BaseTest:
                             self.target.compile(hart, *compile_args)
                 self.binaries.append(BaseTest.compiled.get(key))
 
+    def server_pool_key(self):
+        return (self.target.name, self.freertos())
+
     def classSetup(self):
         self.compile()
+        pooled = None
+        if reuse_servers:
+            pooled = BaseTest.server_pool.pop(self.server_pool_key(), None)
+        if pooled and all(alive(p) for p in pooled):
+            self.target_process, self.server = pooled
+            self.server_reused = True
+            if self.target_process:
+                self.logs += self.target_process.lognames
+            self.logs.append(self.server.logname)
+            # Earlier tests' output was already printed with their results.
+            for log in self.logs:
+                self.log_offsets[log] = os.path.getsize(log)
+            # Put the target back in a known state instead of whatever the
+            # previous test left behind. Reset doesn't make harts available
+            # again, so undo any set_available() first.
+            if self.target.support_unavailable_control:
+                self.server.set_available(self.target.harts)
+            self.server.command("reset halt")
+            return
+
         self.target_process = self.target.create()
         if self.target_process:
             self.logs += self.target_process.lognames
@@ -1351,6 +1737,12 @@ class BaseTest:
             raise
 
     def classTeardown(self):
+        # Only hand servers on if the test passed. After a failure they may be
+        # wedged, or the target may be in a state the reset doesn't undo.
+        if reuse_servers and self.server and self.result in good_results and \
+                alive(self.target_process) and alive(self.server):
+            BaseTest.server_pool[self.server_pool_key()] = \
+                    (self.target_process, self.server)
         del self.server
         del self.target_process
 
@@ -1374,6 +1766,8 @@ class BaseTest:
             return "not_applicable"
 
         self.start = time.time()
+        # In case something other than an Exception gets raised.
+        result = "exception"
 
         try:
             self.classSetup()
@@ -1405,9 +1799,11 @@ class BaseTest:
             logs = []
             for log in self.logs:
                 # pylint: disable=consider-using-with
-                logs.append((log,
-                             open(log, "r", errors='ignore', encoding='utf-8')))
+                handle = open(log, "r", errors='ignore', encoding='utf-8')
+                handle.seek(self.log_offsets.get(log, 0))
+                logs.append((log, handle))
 
+            self.result = result or 'pass'
             self.classTeardown()
             for name, handle in logs:
                 print_log_handle(name, handle)
@@ -1417,9 +1813,21 @@ class BaseTest:
             result = 'pass'
         return result
 
+def alive(process_owner):
+    """Return true iff the process owned by the given Spike/Openocd/... object
+    is still running. None (no process) counts as alive."""
+    if process_owner is None:
+        return True
+    process = getattr(process_owner, 'process', None)
+    return process is not None and process.poll() is None
+
+# Kill any pooled servers before the interpreter starts tearing down modules.
+atexit.register(BaseTest.server_pool.clear)
+
 gdb_cmd = None
 target_timeout = None
 remotelogfile_enable = False
+reuse_servers = False
 class GdbTest(BaseTest):
     def __init__(self, target, hart=None):
         BaseTest.__init__(self, target, hart=hart)
@@ -1519,6 +1927,18 @@ class GdbSingleHartTest(GdbTest):
         GdbTest.classSetup(self)
         self.parkOtherHarts()
 
+# Value of the MXL field (the top two bits of misa) for each XLEN.
+_MISA_MXL = {32: 1, 64: 2, 128: 3}
+_MISA_LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+# _MISA_BYTE_LETTERS[i][b] is the extension letters encoded by b in byte i of
+# misa.
+_MISA_BYTE_LETTERS = tuple(
+        tuple("".join(_MISA_LETTERS[8 * i + bit]
+                      for bit in range(8)
+                      if value & (1 << bit) and 8 * i + bit < 26)
+              for value in range(256))
+        for i in range(4))
+
 class ExamineTarget(GdbTest):
     def test(self):
         for hart in self.target.harts:
@@ -1526,27 +1946,20 @@ class ExamineTarget(GdbTest):
 
             hart.misa = self.gdb.p("$misa")
 
-            txt = "RV"
-            misa_xlen = 0
-            if ((hart.misa & 0xFFFFFFFF) >> 30) == 1:
-                misa_xlen = 32
-            elif ((hart.misa & 0xFFFFFFFFFFFFFFFF) >> 62) == 2:
-                misa_xlen = 64
-            elif ((hart.misa & 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF) >> 126) == 3:
-                misa_xlen = 128
+            for misa_xlen, mxl in _MISA_MXL.items():
+                if (hart.misa >> (misa_xlen - 2)) & 3 == mxl:
+                    break
             else:
                 raise TestFailed("Couldn't determine XLEN from $misa "
-                                 f"(0x{self.hart.misa:x})")
+                                 f"(0x{hart.misa:x})")
 
             if misa_xlen != hart.xlen:
                 raise TestFailed(f"MISA reported XLEN of {misa_xlen} but we "
                         f"were expecting XLEN of {hart.xlen}\n")
 
-            txt += f"{misa_xlen}"
-
-            for i in range(26):
-                if hart.misa & (1<<i):
-                    txt += chr(i + ord('A'))
+            txt = f"RV{misa_xlen}" + "".join(
+                    letters[(hart.misa >> (8 * i)) & 0xff]
+                    for i, letters in enumerate(_MISA_BYTE_LETTERS))
             print(txt, end=" ")
 
 class TestFailed(Exception):